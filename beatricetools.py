@@ -1,13 +1,60 @@
 import ast
-from functools import singledispatch
+from functools import lru_cache, singledispatch
 import re
-from typing import Any, List, Optional, overload, Tuple
+import sys
+from typing import Any, Iterable, List, Optional, overload, Tuple
+from weakref import WeakKeyDictionary
 
 import vapoursynth as vs
 from vapoursynth import core
 
-
-class ExprStr(ast.NodeVisitor):
+# Valid clip names
+_VARIABLES = frozenset('abcdefghijklmnopqrstuvwxyz')
+
+# Available operators and their Expr respresentation
+_OPERATORS = {
+    ast.Add:  '+',
+    ast.Sub:  '-',
+    ast.Mult: '*',
+    ast.Div:  '/',
+
+    ast.Eq:   '=',
+    ast.Gt:   '>',
+    ast.Lt:   '<',
+    ast.GtE: '>=',
+    ast.LtE: '<=',
+
+    ast.Not: 'not',
+    ast.And: 'and',
+    ast.Or:  'or',
+    # ???: 'xor',
+}
+
+# String form of small integer constants, which are common in expressions
+# (0, 128, 255, etc.)
+_INT_STR = tuple(str(i) for i in range(257))
+
+# Tokens and binary operators' precedence of the subset of expressions
+# converted by _fast_postfix()
+_TOKEN_RE = re.compile(
+    r'[ \t]*(?:(?P<num>[0-9]+\.[0-9]*|\.[0-9]+|[0-9]+)|(?P<name>[a-z]+)'
+    r'|(?P<op>==|>=|<=|[-+*/<>])|(?P<paren>[()])|(?P<comma>,))')
+_PRECEDENCE = {
+    '=':  1,
+    '>':  1,
+    '<':  1,
+    '>=': 1,
+    '<=': 1,
+
+    '+': 2,
+    '-': 2,
+
+    '*': 3,
+    '/': 3,
+}
+
+
+class ExprStr:
     """
     Drop-in wrapper for Expr() string in infix form.
 
@@ -38,26 +85,7 @@ class ExprStr(ast.NodeVisitor):
     ``a sqrt b 100 < 0 c ? * e abs``
     """
 
-    variables = 'abcdefghijklmnopqrstuvwxyz'
-
-    # Available operators and their Expr respresentation
-    operators = {
-        ast.Add:  '+',
-        ast.Sub:  '-',
-        ast.Mult: '*',
-        ast.Div:  '/',
-
-        ast.Eq:   '=',
-        ast.Gt:   '>',
-        ast.Lt:   '<',
-        ast.GtE: '>=',
-        ast.LtE: '<=',
-
-        ast.Not: 'not',
-        ast.And: 'and',
-        ast.Or:  'or',
-        # ???: 'xor',
-    }
+    __slots__ = ('stack', '_push')
 
     # Avaialable fixed-name functions and number of their arguments
     functions = {
@@ -72,12 +100,20 @@ class ExprStr(ast.NodeVisitor):
     }
 
     # Available functions with names defined as regexp and number of their
-    # arguments
+    # arguments. Patterns must not contain capturing groups.
     functions_re = {
-        # re.compile(r'dup\d*') : 1,
-        # re.compile(r'swap\d*'): 2,
+        # r'dup\d*':  1,
+        # r'swap\d*': 2,
     }
 
+    # All of the above merged into a single pattern, so function name is
+    # matched only once. Index of the matched group selects number of
+    # arguments.
+    _re_functions = re.compile(
+        '|'.join('({})'.format(pattern) for pattern in functions_re)
+        or '(?!)')
+    _re_functions_args = tuple(functions_re.values())
+
     @overload
     def __new__(cls, string: str) -> 'ExprStr': ...
     @overload
@@ -100,123 +136,313 @@ class ExprStr(ast.NodeVisitor):
             else:
                 string = kwargs['string']
 
-        obj = object.__new__(cls)
-        obj.__init__(string)
-
         if filter_mode:
+            postfix = _expr_to_postfix(string)
             if len(args) > 1:
                 new_args = list(args)
-                new_args[1] = str(obj)
+                new_args[1] = postfix
                 return core.std.Expr(*new_args, **kwargs)
             else:
-                kwargs['string'] = str(obj)
+                kwargs['string'] = postfix
                 return core.std.Expr(*args, **kwargs)
         else:
-            return obj
+            return object.__new__(cls)
 
     def __init__(self, string: str):
-        self.stack: List[str] = []
-        # 'eval' mode takes care of assignment operator
-        self.visit(ast.parse(string, mode='eval'))
+        self.stack: List[str] = [_expr_to_postfix(string)]
+
+    @staticmethod
+    def compile_many(strings: Iterable[str]) -> List[str]:
+        """
+        Converts several infix expressions to Expr() strings at once,
+        e.g. per-plane expressions built in a loop.
+
+        Usage:
+
+        ``core.std.Expr(clip, ExprStr.compile_many(['x * 2', 'x', 'x']))``
+        """
+        return [_expr_to_postfix(string) for string in strings]
+
+    def _parse(self, string: str) -> str:
+        self.stack = []
+        self._push = self.stack.append
+        # 'eval' mode takes care of assignment operator.
+        # compile() is called directly to skip ast.parse() wrapper.
+        self.visit(compile(string, '<ExprStr>', 'eval', ast.PyCF_ONLY_AST,
+                           dont_inherit=True))
+        return ' '.join(self.stack)
+
+    def visit(self, node: ast.AST) -> None:
+        visitor = self._dispatch.get(type(node))
+        if visitor is None:
+            raise SyntaxError(
+                'ExprStr: "{}" at column {} is not supported.'
+                .format(type(node).__name__, node.col_offset))
+        visitor(self, node)
+
+    def visit_Expression(self, node: ast.Expression) -> None:
+        self.visit(node.body)
+
+    def visit_Constant(self, node: ast.Constant) -> None:
+        self._push_number(node.value, node.col_offset)
+
+    # Python 3.7 emits Num nodes for numeric literals
+    if sys.version_info < (3, 8):
+        def visit_Num(self, node: ast.Num) -> None:
+            self._push_number(node.n, node.col_offset)
 
-    def visit_Num(self, node: ast.Num) -> None:
-        self.stack.append(str(node.n))
+    def _push_number(self, n: Any, col_offset: int) -> None:
+        if isinstance(n, bool) or not isinstance(n, (int, float)):
+            raise SyntaxError(
+                'ExprStr: constant "{}" at column {} is not supported.'
+                .format(n, col_offset))
+
+        if type(n) is int and n < len(_INT_STR):
+            self._push(_INT_STR[n])
+        else:
+            self._push(str(n))
 
     def visit_Name(self, node: ast.Name) -> None:
-        if (len(node.id) > 1
-                or node.id not in self.variables):
+        if node.id not in _VARIABLES:
             raise SyntaxError(
                 'ExprStr: clip name "{}" at column {} is not valid.'
                 .format(node.id, node.col_offset))
 
-        self.stack.append(node.id)
+        self._push(node.id)
 
     def visit_Compare(self, node: ast.Compare) -> Any:
         if len(node.ops) > 1:
             raise SyntaxError(
                 'ExprStr: chaining of comparison operators at column {}'
                 ' is not supported'.format(node.col_offset))
-        op = node.ops[0]
 
-        if type(op) not in self.operators:
+        op = _OPERATORS.get(type(node.ops[0]))
+        if op is None:
             raise SyntaxError(
                 'ExprStr: operator "{}" at column {} is not supported.'
-                .format(op, node.col_offset))
-        self.stack.append(self.operators[type(op)])
-        self.visit(node.comparators[0])
+                .format(type(node.ops[0]), node.col_offset))
         self.visit(node.left)
+        self.visit(node.comparators[0])
+        self._push(op)
 
     def visit_UnaryOp(self, node: ast.UnaryOp) -> Any:
-        if type(node.op) not in self.operators:
+        op = _OPERATORS.get(type(node.op))
+        if op is None:
             raise SyntaxError(
                 'ExprStr: operator "{}" at column {} is not supported.'
                 .format(type(node.op), node.col_offset))
-        self.stack.append(self.operators[type(node.op)])
         self.visit(node.operand)
+        self._push(op)
 
     def visit_BoolOp(self, node: ast.BoolOp) -> Any:
-        if type(node.op) not in self.operators:
+        op = _OPERATORS.get(type(node.op))
+        if op is None:
             raise SyntaxError(
                 'ExprStr: operator "{}" at column {} is not supported.'
                 .format(type(node.op), node.col_offset))
 
-        self.stack.append(self.operators[type(node.op)])
-
         self.visit(node.values[0])
         self.visit(node.values[1])
 
+        self._push(op)
+
     def visit_BinOp(self, node: ast.BinOp) -> Any:
-        if type(node.op) not in self.operators:
+        op = _OPERATORS.get(type(node.op))
+        if op is None:
             raise SyntaxError(
                 'ExprStr: operator "{}" at column {} is not supported.'
                 .format(type(node.op), node.col_offset))
 
-        self.stack.append(self.operators[type(node.op)])
-
-        self.visit(node.right)
         self.visit(node.left)
+        self.visit(node.right)
+
+        self._push(op)
 
     def visit_Call(self, node: ast.Call) -> Any:
-        import re
-
-        is_re_function = False
-        args_required = 0
-        if node.func.id not in self.functions:
-            for pattern, args_count in self.functions_re.items():
-                if pattern.fullmatch(node.func.id):
-                    is_re_function = True
-                    args_required = args_count
-                    break
-
-            if not is_re_function:
+        if not isinstance(node.func, ast.Name):
+            raise SyntaxError(
+                'ExprStr: called object at column {} is not a function name.'
+                .format(node.col_offset))
+        name = node.func.id
+
+        args_required = self.functions.get(name)
+        if args_required is None:
+            match = self._re_functions.fullmatch(name)
+            if match is None:
                 raise SyntaxError(
                     'ExprStr: function "{}" at column {} is not supported.'
-                    .format(node.func.id, node.col_offset))
+                    .format(name, node.col_offset))
 
-        if not is_re_function:
-            args_required = self.functions[node.func.id]
+            args_required = self._re_functions_args[match.lastindex - 1]
 
         if len(node.args) != args_required:
             raise SyntaxError(
                 'ExprStr: function "{}" at column {}'
                 ' takes exactly {} arguments, but {} provided.'
-                .format(node.func.id, node.col_offset, args_required,
+                .format(name, node.col_offset, args_required,
                         len(node.args)))
 
-        self.stack.append(node.func.id)
-
-        for arg in node.args[::-1]:
+        for arg in node.args:
             self.visit(arg)
 
-    def visit_IfExp(self, node: ast.IfExp) -> Any:
-        self.stack.append('?')
+        self._push(name)
 
-        self.visit(node.orelse)
-        self.visit(node.body)
+    def visit_IfExp(self, node: ast.IfExp) -> Any:
         self.visit(node.test)
+        self.visit(node.body)
+        self.visit(node.orelse)
+
+        self._push('?')
+
+    # Node type to visitor mapping, used instead of NodeVisitor's
+    # getattr()-based lookup
+    _dispatch = {
+        ast.Expression: visit_Expression,
+        ast.Constant:   visit_Constant,
+        ast.Name:       visit_Name,
+        ast.Compare:    visit_Compare,
+        ast.UnaryOp:    visit_UnaryOp,
+        ast.BoolOp:     visit_BoolOp,
+        ast.BinOp:      visit_BinOp,
+        ast.Call:       visit_Call,
+        ast.IfExp:      visit_IfExp,
+    }
+    if sys.version_info < (3, 8):
+        _dispatch[ast.Num] = visit_Num
 
     def __str__(self) -> str:
-        return ' '.join(self.stack[::-1])
+        return self.stack[0]
+
+
+@lru_cache(maxsize=1024)
+def _expr_to_postfix(string: str) -> str:
+    """
+    Converts infix expression to postfix form used by Expr().
+    Results are cached, since the same strings are usually passed
+    over and over again (e.g. for every plane or every clip in a loop).
+    """
+    postfix = _fast_postfix(string)
+    if postfix is None:
+        postfix = object.__new__(ExprStr)._parse(string)
+    return postfix
+
+
+def _fast_postfix(string: str) -> Optional[str]:
+    """
+    Shunting-yard conversion of arithmetic and comparison expressions
+    made of numbers, clip names and fixed-name function calls,
+    which avoids building Python AST for them.
+    Returns None for everything else, including invalid input,
+    leaving it to ExprStr's own parsing and error reporting.
+    """
+    # Leading whitespace is an error in Python, trailing one is not
+    if string[:1] in (' ', '\t'):
+        return None
+    string = string.rstrip(' \t')
+
+    output: List[str] = []
+    # Operators, opening parentheses and names of called functions
+    operators: List[str] = []
+    # Number of arguments for every opening parenthesis on the operators
+    # stack, or None for parentheses that are not function calls
+    arguments: List[Optional[int]] = []
+    expect_operand = True
+    call = False
+    pos = 0
+
+    while pos < len(string):
+        match = _TOKEN_RE.match(string, pos)
+        if match is None:
+            return None
+        pos = match.end()
+        kind = match.lastgroup
+        token = match.group(kind)
+
+        if call and token != '(':
+            return None
+
+        if kind == 'num':
+            if not expect_operand:
+                return None
+            if '.' in token:
+                output.append(str(float(token)))
+            elif token[0] != '0':
+                # Already in the same form as str(int(token))
+                output.append(token)
+            elif token.strip('0'):
+                # Leading zeros are not allowed in Python integers
+                return None
+            else:
+                output.append('0')
+            expect_operand = False
+
+        elif kind == 'name':
+            if not expect_operand:
+                return None
+            if token in ExprStr.functions:
+                operators.append(token)
+                call = True
+            elif token in _VARIABLES:
+                output.append(token)
+                expect_operand = False
+            else:
+                return None
+
+        elif kind == 'op':
+            if expect_operand:
+                return None
+            if token == '==':
+                token = '='
+            precedence = _PRECEDENCE[token]
+            while (operators
+                   and _PRECEDENCE.get(operators[-1], 0) >= precedence):
+                if precedence == 1 and _PRECEDENCE[operators[-1]] == 1:
+                    # Chained comparison
+                    return None
+                output.append(operators.pop())
+            operators.append(token)
+            expect_operand = True
+
+        elif token == '(':
+            if not expect_operand:
+                return None
+            arguments.append(1 if call else None)
+            operators.append(token)
+            call = False
+
+        else:
+            # Closing parenthesis or comma
+            if expect_operand:
+                return None
+            while operators and operators[-1] != '(':
+                output.append(operators.pop())
+            if not operators:
+                return None
+
+            if kind == 'comma':
+                if arguments[-1] is None:
+                    return None
+                arguments[-1] += 1
+                expect_operand = True
+            else:
+                operators.pop()
+                args_count = arguments.pop()
+                if args_count is not None:
+                    function = operators.pop()
+                    if args_count != ExprStr.functions[function]:
+                        return None
+                    output.append(function)
+
+    if expect_operand or call:
+        return None
+
+    while operators:
+        token = operators.pop()
+        if token == '(':
+            return None
+        output.append(token)
+
+    return ' '.join(output)
 
 
 def extract_planes(clip: vs.VideoNode, plane_format: vs.Format = vs.GRAY) \
@@ -236,8 +462,33 @@ def extract_planes(clip: vs.VideoNode, plane_format: vs.Format = vs.GRAY) \
     :param Format plane_format: Format to use for each extracted plane.
     :return: List with every plane of clip in order they're stored.
     """
-    return [core.std.ShufflePlanes(clip, i, plane_format)
-            for i in range(clip.format.num_planes)]
+    try:
+        clip_planes = _planes_cache.setdefault(clip, {})
+    except TypeError:
+        # Clip doesn't support weak references, extract without caching
+        return list(_shuffle_planes(clip, plane_format))
+
+    planes = clip_planes.get(plane_format)
+    if planes is None:
+        planes = clip_planes[plane_format] = _shuffle_planes(clip,
+                                                             plane_format)
+    return list(planes)
+
+
+# Planes extracted by extract_planes() for every plane format requested,
+# per clip. Clips are referenced weakly, so the cache doesn't keep filter
+# graphs and their cores alive once the script (or a previewer reloading
+# it) drops them.
+_planes_cache: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def _shuffle_planes(clip: vs.VideoNode, plane_format: vs.Format) \
+        -> Tuple[vs.VideoNode, ...]:
+    if plane_format == vs.GRAY and hasattr(core.std, 'SplitPlanes'):
+        # Single call instead of one per plane, in newer VapourSynth
+        return tuple(core.std.SplitPlanes(clip))
+    return tuple(core.std.ShufflePlanes(clip, i, plane_format)
+                 for i in range(clip.format.num_planes))
 
 
 def get_subsampling(w: int, h: int, separator='') -> str: